@@ -57,6 +57,11 @@ class CaptioningSolver(object):
       - features: Array giving a minibatch of features for images, of shape (N, D
       - captions: Array of captions for those images, of shape (N, T) where
         each element is in the range (0, V].
+      - mask: Only passed if the model also has a loss_mask(captions) method;
+        the rows of loss_mask(data['train_captions']) for this minibatch.
+      - reuse_grads: Only passed, as True, if the solver was constructed with
+        reuse_grads=True; the model may then return gradient arrays that it
+        overwrites on the next call.
 
       Returns:
       - loss: Scalar giving the loss
@@ -88,6 +93,10 @@ class CaptioningSolver(object):
           iterations.
         - verbose: Boolean; if set to false then no output will be printed during
           training.
+        - reuse_grads: Boolean; if set to true then model.loss is called with
+          reuse_grads=True, letting it write gradients into buffers that it
+          reuses across steps. Only use this if model.loss accepts it.
+          Default is False.
         """
         self.model = model
         self.data = data
@@ -101,6 +110,7 @@ class CaptioningSolver(object):
 
         self.print_every = kwargs.pop('print_every', 10)
         self.verbose = kwargs.pop('verbose', True)
+        self.reuse_grads = kwargs.pop('reuse_grads', False)
 
         # Throw an error if there are extra keyword arguments
         if len(kwargs) > 0:
@@ -129,6 +139,12 @@ class CaptioningSolver(object):
         self.train_acc_history = []
         self.val_acc_history = []
 
+        # The loss mask only depends on the captions, so compute it once for the
+        # whole training set instead of once per minibatch
+        self.train_mask = None
+        if hasattr(self.model, 'loss_mask'):
+            self.train_mask = self.model.loss_mask(self.data['train_captions'])
+
         # Make a deep copy of the optim_config for each parameter
         self.optim_configs = {}
         for p in self.model.params:
@@ -141,14 +157,21 @@ class CaptioningSolver(object):
         Make a single gradient update. This is called by train() and should not
         be called manually.
         """
-        # Make a minibatch of training data
+        # Make a minibatch of training data; the indices pick out the matching
+        # rows of the mask
         minibatch = sample_coco_minibatch(self.data,
                       batch_size=self.batch_size,
-                      split='train')
-        captions, features, urls = minibatch
+                      split='train',
+                      return_idxs=True)
+        captions, features, urls, idxs = minibatch
 
         # Compute loss and gradient
-        loss, grads = self.model.loss(features, captions)
+        loss_kwargs = {}
+        if self.train_mask is not None:
+            loss_kwargs['mask'] = self.train_mask[idxs]
+        if self.reuse_grads:
+            loss_kwargs['reuse_grads'] = True
+        loss, grads = self.model.loss(features, captions, **loss_kwargs)
         self.loss_history.append(loss)
 
         # Perform a parameter update
@@ -1,9 +1,136 @@
 from builtins import range
 from builtins import object
 import numpy as np
+from scipy.linalg import blas
 
 from cs231n.layers import *
 from cs231n.rnn_layers import *
+from cs231n.rnn_layers import _lstm_cell_forward
+
+try:
+    import numba
+    from numba import prange
+except ImportError:
+    numba = None
+    prange = range
+
+
+def _argmax_affine_row(h, W_vocab_T, b_vocab):
+    """
+    Compute np.argmax(W_vocab_T.dot(h) + b_vocab) for a single hidden state
+    without forming the (V,) score vector: only the best score seen so far is
+    kept while walking over the vocabulary.
+
+    Inputs:
+    - h: Hidden state, of shape (H,)
+    - W_vocab_T: Transposed hidden-to-vocab weights, of shape (V, H); these are
+      transposed so that the weights for one word are contiguous
+    - b_vocab: Hidden-to-vocab biases, of shape (V,)
+
+    Returns:
+    - best_j: Index of the highest scoring word
+    """
+    H = h.shape[0]
+    V = b_vocab.shape[0]
+    # Seed with the score of word 0 rather than -inf: the kernel is compiled
+    # with fastmath, which lets LLVM assume no value is infinite.
+    best = b_vocab[0]
+    for k in range(H):
+        best += h[k] * W_vocab_T[0, k]
+    best_j = 0
+    for j in range(1, V):
+        s = b_vocab[j]
+        for k in range(H):
+            s += h[k] * W_vocab_T[j, k]
+        if s > best:
+            best = s
+            best_j = j
+    return best_j
+
+
+def _sample_loop(h, E, Wx, Wh, b, W_vocab_T, b_vocab, project, start, end,
+                 null, max_length):
+    """
+    Greedy decoding loop for a vanilla RNN, written so that numba can compile
+    the whole loop; the embedding gather, the tanh recurrence, the vocabulary
+    affine and the argmax are fused into one compiled function instead of
+    dispatching into the layer functions at every timestep.
+
+    The rows of the minibatch never interact, so each one is decoded through
+    all timesteps on its own thread; at each step a row only needs a (W, H) or
+    (H, H) vector-matrix product, which is too small for BLAS threading to
+    help.
+
+    Inputs:
+    - h: Initial hidden state, of shape (N, H)
+    - E: Either the word embedding matrix W_embed of shape (V, W), or the
+      precomputed table W_embed.dot(Wx) + b of shape (V, H)
+    - Wx, Wh, b, b_vocab: Model parameters
+    - W_vocab_T: Transposed hidden-to-vocab weights, of shape (V, H)
+    - project: If True then E is W_embed and rows of E still need to be
+      multiplied by Wx; if False then E is the precomputed table
+    - start: Index of the <START> token
+    - end: Index of the <END> token, or -1 if there is none; a row stops
+      once it has produced it
+    - null: Index of the <NULL> token, used to pad finished rows
+    - max_length: Number T of words to sample
+
+    Returns:
+    - captions: Integer array of shape (N, T) of sampled word indices
+    """
+    N = h.shape[0]
+    captions = np.full((N, max_length), null, dtype=np.int32)
+    for n in prange(N):
+        h_n = h[n].copy()
+        word = start
+        for t in range(max_length):
+            if project:
+                pre = np.dot(E[word], Wx) + b
+            else:
+                pre = E[word].copy()
+            h_n = np.tanh(pre + np.dot(h_n, Wh))
+            word = _argmax_affine_row_nb(h_n, W_vocab_T, b_vocab)
+            captions[n, t] = word
+            if word == end:
+                break
+    return captions
+
+
+if numba is not None:
+    _argmax_affine_row_nb = numba.njit(fastmath=True, cache=True)(
+        _argmax_affine_row)
+    _sample_loop_nb = numba.njit(parallel=True, fastmath=True, cache=True)(
+        _sample_loop)
+else:
+    _argmax_affine_row_nb = None
+    _sample_loop_nb = None
+
+
+def _dot(x, W, out, gemv=None):
+    """
+    Compute np.dot(x, W, out=out). If gemv is given (the BLAS gemv routine for
+    the dtype of W) and x has a single row, it is called directly so that the
+    product runs as a matrix-vector product rather than a one-row GEMM; W.T is
+    a Fortran-ordered view, so BLAS reads W in place without a copy.
+
+    This only helps on older NumPy releases such as the pinned 1.12, which run
+    a one-row product as a GEMM; recent NumPy already calls gemv and shows no
+    difference. It is only reached for LSTMs or when numba is missing, since
+    single-row RNN sampling otherwise goes through the compiled loop.
+
+    Inputs:
+    - x: Array of shape (n, K)
+    - W: C-contiguous array of shape (K, M)
+    - out: C-contiguous array of shape (n, M) that receives the product
+    - gemv: Optional BLAS gemv routine from scipy.linalg.blas
+    """
+    if gemv is not None and x.shape[0] == 1:
+        # overwrite_y normally makes gemv write into out[0] and return it, but
+        # f2py may return a copy instead (e.g. on a dtype mismatch), so always
+        # store the result
+        out[0] = gemv(1.0, W.T, x[0], y=out[0], overwrite_y=1)
+    else:
+        np.dot(x, W, out=out)
 
 
 class CaptioningRNN(object):
@@ -75,8 +202,42 @@ class CaptioningRNN(object):
         for k, v in self.params.items():
             self.params[k] = v.astype(self.dtype)
 
+        # Gradient buffers that loss writes into when called with reuse_grads
+        self._grads = {}
+        self._grad_buffers()
+
+
+    def _grad_buffers(self):
+        """
+        Return the persistent dictionary of gradient buffers parallel to
+        self.params, reallocating any buffer whose parameter has been replaced
+        by an array of a different shape or dtype.
+        """
+        for k, v in self.params.items():
+            g = self._grads.get(k)
+            if g is None or g.shape != v.shape or g.dtype != v.dtype:
+                self._grads[k] = np.empty_like(v)
+        return self._grads
+
+
+    def loss_mask(self, captions):
+        """
+        Compute the mask used by loss for a set of captions. The mask only depends
+        on the captions, so a training driver that draws minibatches from a fixed
+        set of captions can compute it once for all of them and pass rows of it
+        to loss.
+
+        Inputs:
+        - captions: Integer array of shape (N, T) of ground-truth captions
 
-    def loss(self, features, captions):
+        Returns:
+        - mask: Array of shape (N, T - 1) and dtype self.dtype giving 1 where the
+          expected output word is not <NULL> and 0 where it is.
+        """
+        return (captions[:, 1:] != self._null).astype(self.dtype)
+
+
+    def loss(self, features, captions, mask=None, reuse_grads=False):
         """
         Compute training-time loss for the RNN. We input image features and
         ground-truth captions for those images, and use an RNN (or LSTM) to compute
@@ -86,11 +247,23 @@ class CaptioningRNN(object):
         - features: Input image features, of shape (N, D)
         - captions: Ground-truth captions; an integer array of shape (N, T) where
           each element is in the range 0 <= y[i, t] < V
+        - mask: Optional mask of shape (N, T - 1) for these captions, as returned
+          by loss_mask. If not given it is computed from captions.
+        - reuse_grads: If True, the gradients are written into buffers owned by
+          the model, which are overwritten by the next call with reuse_grads=True.
+          This saves allocating them on every training step, but the caller must
+          be done with grads before calling loss again.
 
         Returns a tuple of:
         - loss: Scalar loss
-        - grads: Dictionary of gradients parallel to self.params
+        - grads: Dictionary of gradients parallel to self.params.
         """
+        # Keep everything in self.dtype: float64 features (as they come out of
+        # the data loader) would otherwise silently promote the whole forward
+        # and backward pass to float64.
+        features = np.ascontiguousarray(features, dtype=self.dtype)
+        captions = np.ascontiguousarray(captions, dtype=np.int32)
+
         # Cut captions into two pieces: captions_in has everything but the last word
         # and will be input to the RNN; captions_out has everything but the first
         # word and this is what we will expect the RNN to generate. These are offset
@@ -101,7 +274,8 @@ class CaptioningRNN(object):
         captions_out = captions[:, 1:]
 
         # You'll need this
-        mask = (captions_out != self._null)
+        if mask is None:
+            mask = self.loss_mask(captions)
 
         # Weight and bias for the affine transform from image features to initial
         # hidden state
@@ -116,17 +290,27 @@ class CaptioningRNN(object):
         # Weight and bias for the hidden-to-vocab transformation.
         W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
 
-        loss, grads = 0.0, {}
+        loss = 0.0
+        if reuse_grads:
+            grads = self._grad_buffers()
+        else:
+            grads = {k: np.empty_like(v) for k, v in self.params.items()}
         
         # Forward pass
         
         # 1. Use an affine transformation to compute the initial hidden state
-        #    from the image features. This should produce an array of shape (N, H)      
-        h0 = np.dot(features, W_proj)+b_proj
+        #    from the image features. This should produce an array of shape (N, H).
+        #    The bias is added in place so no second (N, H) array is allocated.
+        h0 = np.dot(features, W_proj)
+        h0 += b_proj
+        assert h0.dtype == self.dtype
                 
         # 2. Use a word embedding layer to transform the words in captions_in
-        #    from indices to vectors, giving an array of shape (N, T, W). 
-        x, word_embedding_cache = word_embedding_forward(captions_in, W_embed)
+        #    from indices to vectors, giving an array of shape (N, T, W). The
+        #    vectors are gathered time-major, which is the layout the recurrent
+        #    layers cache, so x is a transposed view they can use without a copy.
+        x_tm, word_embedding_cache = word_embedding_forward(captions_in.T, W_embed)
+        x = x_tm.swapaxes(0, 1)
 
         # 3. Use either a vanilla RNN or LSTM (depending on self.cell_type) to
         #    process the sequence of input word vectors and produce hidden state 
@@ -135,45 +319,37 @@ class CaptioningRNN(object):
         if self.cell_type == 'rnn':
             h, rnn_cache = rnn_forward(x, h0, Wx, Wh, b)
         else:
-            raise NotImplementedError('s not implemented' % self.cell_type)
+            h, rnn_cache = lstm_forward(x, h0, Wx, Wh, b)
         
         # 4. Use a (temporal) affine transformation to compute scores over the
-        #    vocabulary at every timestep using the hidden states, giving an
-        #    array of shape (N, T, V).         
-        scores_out, scores_cache = temporal_affine_forward(h, W_vocab, b_vocab)
-        
-        # 5. Use (temporal) softmax to compute loss using captions_out, ignoring
+        #    vocabulary at every timestep using the hidden states, and
+        # 5. use (temporal) softmax to compute loss using captions_out, ignoring
         #    the points where the output word is <NULL> using the mask above.
-        loss, dscores = temporal_softmax_loss(scores_out, captions_out, mask, verbose=False)
+        #    Both are done by one fused layer that also returns the gradients,
+        #    so the (N, T, V) scores are never stored separately.
+        loss, dh, _, _ = temporal_affine_softmax_loss(
+            h, W_vocab, b_vocab, captions_out, mask,
+            dw=grads['W_vocab'], db=grads['b_vocab'])
         
         # Backward pass
         
         # Compute the gradient of the loss with respect to all model parameters. 
         # Use the loss and grads variables defined above to store loss and gradients; 
-        # grads[k] should give the gradients for self.params[k].
-        
-        grads = dict.fromkeys(self.params)
-        
-        dh, dW_vocab, db_vocab = temporal_affine_backward(dscores, scores_cache)
+        # grads[k] should give the gradients for self.params[k]. All backward
+        # functions write the parameter gradients straight into grads.
         
         if self.cell_type == 'rnn':
-            dx, dh0, dWx, dWh, db = rnn_backward(dh, rnn_cache)
+            dx, dh0, _, _, _ = rnn_backward(dh, rnn_cache, dWx=grads['Wx'],
+                                            dWh=grads['Wh'], db=grads['b'])
         else:
-            raise NotImplementedError('s not implemented' % self.cell_type)
+            dx, dh0, _, _, _ = lstm_backward(dh, rnn_cache, dWx=grads['Wx'],
+                                             dWh=grads['Wh'], db=grads['b'])
         
-        dW_embed = word_embedding_backward(dx, word_embedding_cache)
+        word_embedding_backward(dx.swapaxes(0, 1), word_embedding_cache,
+                                dW=grads['W_embed'])
         
-        db_proj = np.sum(dh0, axis=0)
-        dW_proj = np.dot(features.T, dh0)
-        
-        grads['W_proj'] = dW_proj
-        grads['b_proj'] = db_proj
-        grads['W_embed'] = dW_embed
-        grads['Wx'] = dWx
-        grads['Wh'] = dWh
-        grads['b'] = db
-        grads['W_vocab'] = dW_vocab
-        grads['b_vocab'] = db_vocab
+        np.sum(dh0, axis=0, out=grads['b_proj'])
+        np.dot(features.T, dh0, out=grads['W_proj'])
         
         return loss, grads
 
@@ -201,7 +377,10 @@ class CaptioningRNN(object):
         - captions: Array of shape (N, max_length) giving sampled captions,
           where each element is an integer in the range [0, V). The first element
           of captions should be the first sampled word, not the <START> token.
+          Once a caption has produced <END>, the rest of it is <NULL>; sampling
+          stops early when every caption has ended.
         """
+        features = np.ascontiguousarray(features, dtype=self.dtype)
         N = features.shape[0]
         captions = self._null * np.ones((N, max_length), dtype=np.int32)
         V = self.vocab_size
@@ -214,29 +393,90 @@ class CaptioningRNN(object):
         W_vocab, b_vocab = self.params['W_vocab'], self.params['b_vocab']
                 
         # Initial hidden state
-        h0 = np.dot(features, W_proj)+b_proj
+        h0 = np.dot(features, W_proj)
+        h0 += b_proj
+        assert h0.dtype == self.dtype
                 
+        # Every input word is one of the V rows of W_embed, so x.dot(Wx) + b can
+        # only take V distinct values. When we will embed at least V words in
+        # total it is cheaper to compute all of them once up front and gather
+        # rows of that table at each timestep.
+        project = N * max_length < V
+        if project:
+            E = W_embed
+        else:
+            E = np.dot(W_embed, Wx) + b
+
+        # The compiled loop decodes each row on its own thread with
+        # vector-matrix products. Once there are more rows than threads, the
+        # batched matrix products below reuse each weight matrix across rows and
+        # are faster.
+        if (self.cell_type == 'rnn' and _sample_loop_nb is not None and
+                N <= numba.config.NUMBA_NUM_THREADS):
+            W_vocab_T = np.ascontiguousarray(W_vocab.T)
+            end = -1 if self._end is None else self._end
+            return _sample_loop_nb(h0, E, Wx, Wh, b, W_vocab_T, b_vocab, project,
+                                   self._start, end, self._null, max_length)
+
+        # Buffers reused by every timestep, so the loop below does not allocate.
+        # For an LSTM the pre-activations of all four gates are 4H wide and
+        # come out of the same matrix multiplies; the cell state starts at zero.
+        lstm = self.cell_type == 'lstm'
+        G = Wh.shape[1]
+        emb_buf = np.empty((N, E.shape[1]), dtype=self.dtype)
+        proj_buf = np.empty((N, G), dtype=self.dtype) if project else emb_buf
+        pre_buf = np.empty((N, G), dtype=self.dtype)
+        h_buf = np.empty((N, H), dtype=self.dtype)
+        if lstm:
+            c_buf = np.zeros((N, H), dtype=self.dtype)
+            tanh_c_buf = np.empty((N, H), dtype=self.dtype)
+        scores_buf = np.empty((N, V), dtype=self.dtype)
+        word_buf = np.empty(N, dtype=np.intp)
+
+        # A single caption is common when captioning one image; call BLAS gemv
+        # directly for its vector-matrix products
+        gemv = blas.get_blas_funcs('gemv', (Wh,)) if N == 1 else None
+
         # Initial word is the <START> token - Don't include in caption
-        capt = self._start * np.ones((N, 1), dtype=np.int32)
-        word_embed, _ = word_embedding_forward(capt, W_embed)
-
-        # Generate first word and add to captions
-        next_h, _ = rnn_step_forward(np.squeeze(word_embed), h0, Wx, Wh, b)
-        score, _ = temporal_affine_forward(next_h[:, np.newaxis, :], W_vocab, b_vocab)
-        output_word = np.squeeze(np.argmax(score, axis=2))
-        captions[:, 0] = output_word
-        capt = captions[:, 0]
-        
-        for t in range(1,len(captions[0])):
-            word_embed, _ = word_embedding_forward(capt, W_embed)
-            next_h, _ = rnn_step_forward(np.squeeze(word_embed), next_h, Wx, Wh, b)
-            score, _ = temporal_affine_forward(next_h[:, np.newaxis, :], W_vocab, b_vocab)
-            output_word = np.squeeze(np.argmax(score, axis=2))
-            # TODO: remove <END> from caption
-            # if output_word == self.word_to_idx[self._end]:
-            #     return captions
-            # else:
-            captions[:, t] = output_word
-            capt = captions[:, t]
-        
+        next_h = h0
+        word_buf.fill(self._start)
+
+        # Rows of captions that have not produced <END> yet. Only the first n
+        # rows of every buffer are in use; when captions end, the remaining
+        # ones are compacted to the front so finished rows cost nothing.
+        active = np.arange(N)
+        n = N
+
+        for t in range(max_length):
+            _dot(next_h, Wh, pre_buf[:n], gemv)
+            # word_buf only ever holds <START> or argmax results, so the bounds
+            # check (and the buffered copy mode='raise' makes with out) is skipped
+            np.take(E, word_buf[:n], axis=0, out=emb_buf[:n], mode='clip')
+            if project:
+                _dot(emb_buf[:n], Wx, proj_buf[:n], gemv)
+                proj_buf[:n] += b
+            pre_buf[:n] += proj_buf[:n]
+            if lstm:
+                _lstm_cell_forward(pre_buf[:n], c_buf[:n], c_buf[:n],
+                                   tanh_c_buf[:n], h_buf[:n])
+            else:
+                np.tanh(pre_buf[:n], out=h_buf[:n])
+            _dot(h_buf[:n], W_vocab, scores_buf[:n], gemv)
+            scores_buf[:n] += b_vocab
+            np.argmax(scores_buf[:n], axis=1, out=word_buf[:n])
+            captions[active, t] = word_buf[:n]
+
+            if self._end is not None:
+                keep = word_buf[:n] != self._end
+                if not keep.all():
+                    active = active[keep]
+                    h_buf[:active.size] = h_buf[:n][keep]
+                    if lstm:
+                        c_buf[:active.size] = c_buf[:n][keep]
+                    word_buf[:active.size] = word_buf[:n][keep]
+                    n = active.size
+                    if n == 0:
+                        break
+            next_h = h_buf[:n]
+
         return captions
@@ -75,11 +75,16 @@ def decode_captions(captions, idx_to_word):
     return decoded
 
 
-def sample_coco_minibatch(data, batch_size=100, split='train'):
+def sample_coco_minibatch(data, batch_size=100, split='train',
+                          return_idxs=False):
     split_size = data['%s_captions' % split].shape[0]
     mask = np.random.choice(split_size, batch_size)
     captions = data['%s_captions' % split][mask]
     image_idxs = data['%s_image_idxs' % split][mask]
     image_features = data['%s_features' % split][image_idxs]
     urls = data['%s_urls' % split][image_idxs]
+    if return_idxs:
+        # The indices of the drawn captions, for callers that keep other
+        # per-caption arrays alongside data
+        return captions, image_features, urls, mask
     return captions, image_features, urls
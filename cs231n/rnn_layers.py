@@ -1,6 +1,7 @@
 from __future__ import print_function, division
 from builtins import range
 import numpy as np
+from scipy import sparse
 
 
 """
@@ -91,29 +92,43 @@ def rnn_forward(x, h0, Wx, Wh, b):
     Returns a tuple of:
     - h: Hidden states for the entire timeseries, of shape (N, T, H).
     - cache: Values needed in the backward pass
-    """    
-    N,T,D = x.shape
+    """
+    N, T, D = x.shape
     H = h0.shape[1]
-   
-    h = np.zeros((N,T,H))
-    cache = []
-    
-    h[:,0,:], cache_step = rnn_step_forward(x[:,0,:],h0,Wx,Wh,b)
-    cache.append(cache_step)
-    
-    for t in range(1,x.shape[1]):
-        h[:,t,:], cache_step = rnn_step_forward(x[:,t,:],h[:,t-1,:],Wx,Wh,b)
-        cache.append(cache_step)
+
+    # The cache is laid out time-major so that everything one timestep touches
+    # is a single contiguous (N, D) or (N, H) block: X[t] holds the inputs at
+    # timestep t and hs[t + 1] the hidden state after it, with hs[0] = h0.
+    X = np.ascontiguousarray(x.swapaxes(0, 1))
+    hs = np.empty((T + 1, N, H), dtype=np.result_type(x, Wx))
+    hs[0] = h0
+
+    # The input-to-hidden products do not depend on the recurrence, so compute
+    # them for all timesteps with one matrix multiply; the loop below then only
+    # has to apply the hidden-to-hidden weights. The tanh is applied in place,
+    # so the same buffer ends up holding the hidden states.
+    np.dot(X.reshape(T * N, D), Wx, out=hs[1:].reshape(T * N, H))
+    hs[1:] += b
+
+    for t in range(T):
+        z = hs[t + 1]
+        z += np.dot(hs[t], Wh)
+        np.tanh(z, out=z)
+
+    h = hs[1:].swapaxes(0, 1)
+    cache = (X, hs, Wx, Wh)
 
     return h, cache
 
 
-def rnn_backward(dh, cache):
+def rnn_backward(dh, cache, dWx=None, dWh=None, db=None):
     """
     Compute the backward pass for a vanilla RNN over an entire sequence of data.
 
     Inputs:
     - dh: Upstream gradients of all hidden states, of shape (N, T, H)
+    - dWx, dWh, db: Optional arrays to write the weight gradients into; if not
+      given, new arrays are allocated.
 
     Returns a tuple of:
     - dx: Gradient of inputs, of shape (N, T, D)
@@ -122,28 +137,30 @@ def rnn_backward(dh, cache):
     - dWh: Gradient of hidden-to-hidden weights, of shape (H, H)
     - db: Gradient of biases, of shape (H,)
     """
-    
+    X, hs, Wx, Wh = cache
     N, T, H = dh.shape
-    D = cache[0][0].shape[1]
-    
-    dx = np.zeros((T,N,D))
-    dh0 = np.zeros((N,H))
-    dWx = np.zeros((D,H))
-    dWh = np.zeros((H,H))
-    db = np.zeros((H))
-    
-    dh = np.swapaxes(dh.copy(),0,1)
-    dprev_h = np.zeros((N,H))
+    D = X.shape[2]
 
+    # Only the gradient flowing through the hidden-to-hidden connections is
+    # sequential; sweep it backward in time and collect the gradient of the
+    # pre-activations at every timestep, time-major like the cache.
+    dz = np.empty((T, N, H), dtype=hs.dtype)
+    dprev_h = np.zeros((N, H), dtype=hs.dtype)
     for t in reversed(range(T)):
-        dx_t, dprev_h, dWx_t, dWh_t, db_t = rnn_step_backward(dprev_h+dh[t], cache[t])
-        dx[t] += dx_t
-        dWx += dWx_t
-        dWh += dWh_t
-        db += db_t
-        
+        np.multiply(dh[:, t, :] + dprev_h, 1.0 - np.square(hs[t + 1]), out=dz[t])
+        dprev_h = np.dot(dz[t], Wh.T)
     dh0 = dprev_h
-    dx = np.swapaxes(dx,0,1)
+
+    # All weight gradients and the input gradient are then one matrix multiply
+    # over the whole sequence; hs[:-1] is the previous hidden state of every
+    # timestep.
+    dz_flat = dz.reshape(T * N, H)
+    X_flat = X.reshape(T * N, D)
+
+    dx = np.dot(dz_flat, Wx.T).reshape(T, N, D).swapaxes(0, 1)
+    dWx = np.dot(X_flat.T, dz_flat, out=dWx)
+    dWh = np.dot(hs[:-1].reshape(T * N, H).T, dz_flat, out=dWh)
+    db = np.sum(dz_flat, axis=0, out=db)
 
     return dx, dh0, dWx, dWh, db
 
@@ -164,31 +181,49 @@ def word_embedding_forward(x, W):
     - cache: Values needed for the backward pass
     """
     
-    out = W[x]
-    cache = x, W
+    # np.take along a single axis is a plain row copy, cheaper than general
+    # fancy indexing.
+    out = np.take(W, x, axis=0)
+    # The backward pass only scatters into dW, so it needs the indices and the
+    # vocabulary size but not the gathered vectors or W itself.
+    cache = x, W.shape[0]
 
     return out, cache
 
 
-def word_embedding_backward(dout, cache):
+def word_embedding_backward(dout, cache, dW=None):
     """
     Backward pass for word embeddings. We cannot back-propagate into the words
     since they are integers, so we only return gradient for the word embedding
     matrix.
 
-    HINT: Look up the function np.add.at
+    The gradient is a scatter-add of the rows of dout into the rows of dW given
+    by the word indices. Rather than np.add.at, this is written as a product
+    with a sparse one-hot matrix of shape (N * T, V), which sums duplicate
+    indices in compiled code.
 
     Inputs:
     - dout: Upstream gradients of shape (N, T, D)
     - cache: Values from the forward pass
+    - dW: Optional array to write the gradient into; if not given, a new array
+      is allocated.
 
     Returns:
     - dW: Gradient of word embedding matrix, of shape (V, D).
     """
     
-    x, W = cache    
-    dW = np.zeros(W.shape)
-    np.add.at(dW, x, dout)
+    x, V = cache
+    D = dout.shape[-1]
+    x_flat = x.ravel()
+    M = x_flat.size
+
+    one_hot = sparse.csr_matrix(
+        (np.ones(M, dtype=dout.dtype), x_flat, np.arange(M + 1)), shape=(M, V))
+    dW_sparse = one_hot.T.dot(dout.reshape(M, D))
+    if dW is None:
+        dW = dW_sparse
+    else:
+        dW[...] = dW_sparse
     
     return dW
 
@@ -207,6 +242,59 @@ def sigmoid(x):
     return top / (1 + z)
 
 
+def _lstm_cell_forward(a, prev_c, next_c, tanh_c, next_h):
+    """
+    Elementwise part of an LSTM timestep, shared by lstm_step_forward,
+    lstm_forward and CaptioningRNN.sample. Everything is written into arrays
+    given by the caller so that sequence loops can reuse their buffers.
+
+    Inputs:
+    - a: Gate pre-activations of shape (N, 4H); overwritten in place with the
+      gate activations i, f, o, g in that order.
+    - prev_c: Previous cell state, of shape (N, H)
+    - next_c, tanh_c, next_h: Arrays of shape (N, H) that receive the next cell
+      state, its tanh, and the next hidden state. next_c may be prev_c.
+    """
+    H = a.shape[1] // 4
+    a[:, :3 * H] = sigmoid(a[:, :3 * H])
+    np.tanh(a[:, 3 * H:], out=a[:, 3 * H:])
+    i, f, o, g = a[:, :H], a[:, H:2 * H], a[:, 2 * H:3 * H], a[:, 3 * H:]
+
+    np.multiply(f, prev_c, out=next_c)
+    next_c += i * g
+    np.tanh(next_c, out=tanh_c)
+    np.multiply(o, tanh_c, out=next_h)
+
+
+def _lstm_cell_backward(dnext_h, dnext_c, gates, prev_c, tanh_c, da):
+    """
+    Backward pass for _lstm_cell_forward.
+
+    Inputs:
+    - dnext_h, dnext_c: Gradients of the next hidden and cell states, (N, H)
+    - gates: Gate activations of shape (N, 4H) from _lstm_cell_forward
+    - prev_c: Previous cell state, of shape (N, H)
+    - tanh_c: tanh of the next cell state, of shape (N, H)
+    - da: Array of shape (N, 4H) that receives the gradient of the gate
+      pre-activations
+
+    Returns:
+    - dprev_c: Gradient of the previous cell state, of shape (N, H)
+    """
+    H = prev_c.shape[1]
+    i, f, o, g = (gates[:, :H], gates[:, H:2 * H], gates[:, 2 * H:3 * H],
+                  gates[:, 3 * H:])
+
+    dc = dnext_c + dnext_h * o * (1.0 - np.square(tanh_c))
+
+    np.multiply(dc * g, i * (1.0 - i), out=da[:, :H])
+    np.multiply(dc * prev_c, f * (1.0 - f), out=da[:, H:2 * H])
+    np.multiply(dnext_h * tanh_c, o * (1.0 - o), out=da[:, 2 * H:3 * H])
+    np.multiply(dc * i, 1.0 - np.square(g), out=da[:, 3 * H:])
+
+    return dc * f
+
+
 def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     """
     Forward pass for a single timestep of an LSTM.
@@ -227,15 +315,18 @@ def lstm_step_forward(x, prev_h, prev_c, Wx, Wh, b):
     - next_c: Next cell state, of shape (N, H)
     - cache: Tuple of values needed for backward pass.
     """
-    next_h, next_c, cache = None, None, None
-    #############################################################################
-    # TODO: Implement the forward pass for a single timestep of an LSTM.        #
-    # You may want to use the numerically stable sigmoid implementation above.  #
-    #############################################################################
-    pass
-    ##############################################################################
-    #                               END OF YOUR CODE                             #
-    ##############################################################################
+    # All four gates share x and prev_h, so one (D, 4H) and one (H, 4H)
+    # matrix multiply compute the pre-activations of all of them
+    a = np.dot(x, Wx)
+    a += np.dot(prev_h, Wh)
+    a += b
+
+    next_c = np.empty_like(prev_c, dtype=a.dtype)
+    tanh_c = np.empty_like(next_c)
+    next_h = np.empty_like(next_c)
+    _lstm_cell_forward(a, prev_c, next_c, tanh_c, next_h)
+
+    cache = (x, prev_h, prev_c, Wx, Wh, a, tanh_c)
 
     return next_h, next_c, cache
 
@@ -257,17 +348,16 @@ def lstm_step_backward(dnext_h, dnext_c, cache):
     - dWh: Gradient of hidden-to-hidden weights, of shape (H, 4H)
     - db: Gradient of biases, of shape (4H,)
     """
-    dx, dh, dc, dWx, dWh, db = None, None, None, None, None, None
-    #############################################################################
-    # TODO: Implement the backward pass for a single timestep of an LSTM.       #
-    #                                                                           #
-    # HINT: For sigmoid and tanh you can compute local derivatives in terms of  #
-    # the output value from the nonlinearity.                                   #
-    #############################################################################
-    pass
-    ##############################################################################
-    #                               END OF YOUR CODE                             #
-    ##############################################################################
+    x, prev_h, prev_c, Wx, Wh, gates, tanh_c = cache
+
+    da = np.empty_like(gates)
+    dprev_c = _lstm_cell_backward(dnext_h, dnext_c, gates, prev_c, tanh_c, da)
+
+    dx = np.dot(da, Wx.T)
+    dprev_h = np.dot(da, Wh.T)
+    dWx = np.dot(x.T, da)
+    dWh = np.dot(prev_h.T, da)
+    db = np.sum(da, axis=0)
 
     return dx, dprev_h, dprev_c, dWx, dWh, db
 
@@ -294,26 +384,43 @@ def lstm_forward(x, h0, Wx, Wh, b):
     - h: Hidden states for all timesteps of all sequences, of shape (N, T, H)
     - cache: Values needed for the backward pass.
     """
-    h, cache = None, None
-    #############################################################################
-    # TODO: Implement the forward pass for an LSTM over an entire timeseries.   #
-    # You should use the lstm_step_forward function that you just defined.      #
-    #############################################################################
-    pass
-    ##############################################################################
-    #                               END OF YOUR CODE                             #
-    ##############################################################################
+    N, T, D = x.shape
+    H = h0.shape[1]
+    dtype = np.result_type(x, Wx)
+
+    # Same time-major layout as rnn_forward; cs[0] is the zero initial cell
+    # state and gates[t] ends up holding the gate activations of timestep t.
+    X = np.ascontiguousarray(x.swapaxes(0, 1))
+    hs = np.empty((T + 1, N, H), dtype=dtype)
+    hs[0] = h0
+    cs = np.empty((T + 1, N, H), dtype=dtype)
+    cs[0] = 0
+    tanh_cs = np.empty((T, N, H), dtype=dtype)
+
+    # Input-to-hidden products for all four gates and all timesteps at once
+    gates = np.empty((T, N, 4 * H), dtype=dtype)
+    np.dot(X.reshape(T * N, D), Wx, out=gates.reshape(T * N, 4 * H))
+    gates += b
+
+    for t in range(T):
+        gates[t] += np.dot(hs[t], Wh)
+        _lstm_cell_forward(gates[t], cs[t], cs[t + 1], tanh_cs[t], hs[t + 1])
+
+    h = hs[1:].swapaxes(0, 1)
+    cache = (X, hs, cs, gates, tanh_cs, Wx, Wh)
 
     return h, cache
 
 
-def lstm_backward(dh, cache):
+def lstm_backward(dh, cache, dWx=None, dWh=None, db=None):
     """
     Backward pass for an LSTM over an entire sequence of data.]
 
     Inputs:
     - dh: Upstream gradients of hidden states, of shape (N, T, H)
     - cache: Values from the forward pass
+    - dWx, dWh, db: Optional arrays to write the weight gradients into; if not
+      given, new arrays are allocated.
 
     Returns a tuple of:
     - dx: Gradient of input data of shape (N, T, D)
@@ -322,15 +429,28 @@ def lstm_backward(dh, cache):
     - dWh: Gradient of hidden-to-hidden weight matrix of shape (H, 4H)
     - db: Gradient of biases, of shape (4H,)
     """
-    dx, dh0, dWx, dWh, db = None, None, None, None, None
-    #############################################################################
-    # TODO: Implement the backward pass for an LSTM over an entire timeseries.  #
-    # You should use the lstm_step_backward function that you just defined.     #
-    #############################################################################
-    pass
-    ##############################################################################
-    #                               END OF YOUR CODE                             #
-    ##############################################################################
+    X, hs, cs, gates, tanh_cs, Wx, Wh = cache
+    N, T, H = dh.shape
+    D = X.shape[2]
+
+    # Sweep the recurrent gradients backward in time, collecting the gradient
+    # of the gate pre-activations at every timestep
+    da = np.empty_like(gates)
+    dprev_h = np.zeros((N, H), dtype=gates.dtype)
+    dprev_c = np.zeros((N, H), dtype=gates.dtype)
+    for t in reversed(range(T)):
+        dprev_c = _lstm_cell_backward(dh[:, t, :] + dprev_h, dprev_c, gates[t],
+                                      cs[t], tanh_cs[t], da[t])
+        dprev_h = np.dot(da[t], Wh.T)
+    dh0 = dprev_h
+
+    # Weight and input gradients are one matrix multiply over the sequence
+    da_flat = da.reshape(T * N, 4 * H)
+
+    dx = np.dot(da_flat, Wx.T).reshape(T, N, D).swapaxes(0, 1)
+    dWx = np.dot(X.reshape(T * N, D).T, da_flat, out=dWx)
+    dWh = np.dot(hs[:-1].reshape(T * N, H).T, da_flat, out=dWh)
+    db = np.sum(da_flat, axis=0, out=db)
 
     return dx, dh0, dWx, dWh, db
 
@@ -429,3 +549,62 @@ def temporal_softmax_loss(x, y, mask, verbose=False):
     dx = dx_flat.reshape(N, T, V)
 
     return loss, dx
+
+
+def temporal_affine_softmax_loss(x, w, b, y, mask, dw=None, db=None):
+    """
+    Fused temporal affine layer followed by temporal softmax loss. This computes
+    the same loss and gradients as temporal_affine_forward, temporal_softmax_loss
+    and temporal_affine_backward in sequence, but the scores, the softmax
+    probabilities and the gradient of the scores all share a single buffer of
+    shape (N * T, V) that is updated in place.
+
+    Inputs:
+    - x: Input data of shape (N, T, D)
+    - w: Weights of shape (D, V)
+    - b: Biases of shape (V,)
+    - y: Ground-truth indices, of shape (N, T) where each element is in the range
+         0 <= y[i, t] < V
+    - mask: Array of shape (N, T), either boolean or 0/1 floats, where mask[i, t]
+      tells whether or not the scores at timestep t of sequence i should
+      contribute to the loss.
+    - dw, db: Optional arrays to write the weight gradients into; if not given,
+      new arrays are allocated.
+
+    Returns a tuple of:
+    - loss: Scalar giving loss
+    - dx: Gradient of input, of shape (N, T, D)
+    - dw: Gradient of weights, of shape (D, V)
+    - db: Gradient of biases, of shape (V,)
+    """
+    N, T, D = x.shape
+    V = b.shape[0]
+
+    x_flat = x.reshape(N * T, D)
+    y_flat = y.reshape(N * T)
+    mask_flat = mask.reshape(N * T)
+    rows = np.arange(N * T)
+
+    # Scores, then softmax probabilities, in the same buffer. The loss is taken
+    # from the shifted scores (the log-softmax) rather than the log of the
+    # probabilities: in float32 the probability of a masked <NULL> target can
+    # underflow to 0, and 0 * log(0) would make the loss NaN.
+    buf = np.dot(x_flat, w)
+    buf += b
+    buf -= np.max(buf, axis=1, keepdims=True)
+    shifted_y = buf[rows, y_flat]
+    np.exp(buf, out=buf)
+    sums = np.sum(buf, axis=1, keepdims=True)
+    buf /= sums
+
+    loss = -np.sum(mask_flat * (shifted_y - np.log(sums[:, 0]))) / N
+
+    # Gradient of the scores, still in the same buffer
+    buf[rows, y_flat] -= 1
+    buf *= (mask_flat / N).astype(buf.dtype)[:, None]
+
+    dx = np.dot(buf, w.T).reshape(N, T, D)
+    dw = np.dot(x_flat.T, buf, out=dw)
+    db = np.sum(buf, axis=0, out=db)
+
+    return loss, dx, dw, db